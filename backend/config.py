@@ -4,8 +4,17 @@ Agent configuration for PopAd.ai Marketing Agent.
 
 MODEL = "claude-sonnet-4-20250514"
 
+# Faster/cheaper model for simple text-only turns. Turns that call tools are
+# re-run on MODEL, since tool planning benefits from the stronger model.
+FAST_MODEL = "claude-haiku-4-5-20251001"
+ENABLE_MODEL_TIERING = True
+
 AGENT_NAME = "PopAd Agent"
 
+# Keep only the most recent conversation turns in the prompt. Prefill cost is
+# linear in history tokens, so an unbounded history makes every turn slower.
+MAX_HISTORY_TURNS = 20
+
 SYSTEM_PROMPT = """You are the PopAd.ai creative agent. You help e-commerce brands make marketing content with AI.
 
 Be brief. 1-2 sentences max per response. Let the visuals do the talking.
@@ -10,9 +10,18 @@ config.py is gitignored so your custom config stays private.
 # Model to use
 MODEL = "claude-sonnet-4-20250514"
 
+# Faster/cheaper model for simple text-only turns. Turns that call tools are
+# re-run on MODEL, since tool planning benefits from the stronger model.
+FAST_MODEL = "claude-haiku-4-5-20251001"
+ENABLE_MODEL_TIERING = True
+
 # Agent display name
 AGENT_NAME = "Agent"
 
+# Keep only the most recent conversation turns in the prompt. Prefill cost is
+# linear in history tokens, so an unbounded history makes every turn slower.
+MAX_HISTORY_TURNS = 20
+
 # System prompt - customize this for your agent's persona
 SYSTEM_PROMPT = """You are a helpful assistant with access to tools.
 
@@ -4,26 +4,80 @@ AgentUI Backend - FastAPI + WebSocket + Anthropic SDK
 from __future__ import annotations
 
 import asyncio
-import base64
+import binascii
 import logging
+import logging.handlers
 import os
-import traceback
+import queue
+import time
+from contextlib import asynccontextmanager
 from pathlib import Path
 
+import httpx
+import orjson
 from dotenv import load_dotenv
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from anthropic import Anthropic
+from anthropic import AsyncAnthropic
 
-from tools import TOOLS_SCHEMA, execute_tool
-from config import SYSTEM_PROMPT, MODEL
-
-# Load .env from project root
+# Load .env from project root before the local imports: tools reads FAL_KEY
+# at import time.
 load_dotenv(Path(__file__).resolve().parent.parent / ".env")
 
+from tools import TOOLS_SCHEMA, execute_tools, aclose_clients, fal_configured
+from config import (
+    SYSTEM_PROMPT,
+    MODEL,
+    FAST_MODEL,
+    ENABLE_MODEL_TIERING,
+    MAX_HISTORY_TURNS,
+)
+
+
+def _setup_logging() -> logging.handlers.QueueListener:
+    """Route log records through a queue to a background thread.
+
+    Log emission is a blocking stderr write; doing it on a worker thread
+    keeps error/info logging from stalling the event loop (and every other
+    session) under load.
+    """
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    listener.start()
+    return listener
+
+
+_log_listener = _setup_logging()
+
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="AgentUI")
+FAL_KEY = os.environ.get("FAL_KEY")
+FAL_UPLOAD_INITIATE_URL = "https://rest.alpha.fal.ai/storage/upload/initiate"
+
+# Shared connection pool for Fal uploads: one TLS session + HTTP/2
+# multiplexing across all concurrent WebSocket sessions.
+http_client: httpx.AsyncClient | None = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client
+    if not fal_configured():
+        logger.warning("FAL_KEY is not set; image and video tools will return errors")
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=64, max_connections=128),
+        timeout=httpx.Timeout(60.0, connect=10.0),
+    )
+    yield
+    await http_client.aclose()
+    await aclose_clients()
+
+
+app = FastAPI(title="AgentUI", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -33,145 +87,369 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-client = Anthropic()
+# Override the SDK's default HTTP/1.1 transport: with HTTP/2, concurrent
+# streaming sessions multiplex over a few keepalive connections instead of
+# paying a TCP+TLS handshake each.
+client = AsyncAnthropic(
+    http_client=httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=32),
+    )
+)
 
 MAX_TOOL_CALLS = 5
 
+# Text deltas are coalesced before hitting the socket: flush when the buffer
+# reaches this many characters or this much time has passed since the last
+# flush. Collapses one-WS-frame-per-token into a handful of frames per second.
+DELTA_FLUSH_CHARS = 512
+DELTA_FLUSH_INTERVAL = 0.005
+
+# Canonical upload marker. The wording and layout must stay byte-stable
+# across turns: Anthropic prompt caching only hits on identical prefixes, so
+# any drift here invalidates the cache for the rest of the session.
+UPLOAD_MARKER_PREFIX = "[System: User uploaded images. URLs for tools:\n"
+
+# Turns shorter than this (text-only) are routed to FAST_MODEL first.
+FAST_TURN_MAX_CHARS = 100
+
+# Static control frames, serialized once and reused by every session.
+FRAME_CLEARED = orjson.dumps({"type": "cleared"})
+FRAME_THINKING_ON = orjson.dumps({"type": "thinking", "status": True})
+FRAME_THINKING_OFF = orjson.dumps({"type": "thinking", "status": False})
+FRAME_NEW_TURN = orjson.dumps({"type": "new_turn"})
+FRAME_DONE = orjson.dumps({"type": "done"})
+
+# Structured system prompt with a cache breakpoint: the prompt is identical on
+# every call, so Anthropic can serve it from the prompt cache after the first
+# request of a session.
+SYSTEM_BLOCKS = [
+    {
+        "type": "text",
+        "text": SYSTEM_PROMPT,
+        "cache_control": {"type": "ephemeral"},
+    }
+]
+
+# Resolved once: the stream call sits in the tightest loop, so even the
+# `or None` ternary doesn't belong there.
+TOOLS_ARG = TOOLS_SCHEMA or None
+
+
+def mark_cache_breakpoint(messages: list):
+    """Move the conversation cache breakpoint to the last content block.
+
+    The agent loop re-sends the same system prompt and growing history on
+    every tool round-trip, so marking the end of the latest message lets the
+    next call hit the prompt cache for the whole prefix. Only one breakpoint
+    is kept in the history (Anthropic allows at most 4 in total).
+    """
+    for message in messages:
+        for block in message["content"]:
+            block.pop("cache_control", None)
+
+    last_content = messages[-1]["content"]
+    if last_content:
+        last_content[-1]["cache_control"] = {"type": "ephemeral"}
+
+
+def trim_history(messages: list):
+    """Drop the oldest turns once the history window is exceeded.
+
+    A turn starts at a user message that carries real user content (not
+    tool_result follow-ups from the agent loop). Truncating only at turn
+    starts keeps every tool_use/tool_result pair intact, which the API
+    requires.
+    """
+    turn_starts = [
+        i for i, message in enumerate(messages)
+        if message["role"] == "user" and not any(
+            block.get("type") == "tool_result" for block in message["content"]
+        )
+    ]
+    if len(turn_starts) > MAX_HISTORY_TURNS:
+        del messages[:turn_starts[-MAX_HISTORY_TURNS]]
 
-async def upload_base64_to_fal(base64_data: str, media_type: str) -> str | None:
-    """Upload a base64 image to Fal CDN and return the public URL."""
-    fal_key = os.environ.get("FAL_KEY")
-    if not fal_key:
-        return None
-
-    import fal_client
 
-    image_bytes = base64.b64decode(base64_data)
+async def upload_bytes_to_fal(image_bytes: bytes, media_type: str) -> str | None:
+    """Upload image bytes to Fal CDN and return the public URL."""
+    if not FAL_KEY:
+        return None
 
     try:
-        url = await asyncio.to_thread(
-            fal_client.upload, image_bytes, content_type=media_type
+        response = await http_client.post(
+            FAL_UPLOAD_INITIATE_URL,
+            json={"content_type": media_type, "file_name": "upload"},
+            headers={"Authorization": f"Key {FAL_KEY}"},
         )
-        return url
+        response.raise_for_status()
+        upload = response.json()
+
+        response = await http_client.put(
+            upload["upload_url"],
+            content=image_bytes,
+            headers={"Content-Type": media_type},
+        )
+        response.raise_for_status()
+        return upload["file_url"]
     except Exception as e:
         logger.warning(f"Fal CDN upload failed: {e}")
         return None
 
 
+async def receive_json(websocket: WebSocket) -> dict:
+    """Receive one JSON message, accepting binary or text frames.
+
+    The frontend sends binary frames (skipping text-frame UTF-8 validation
+    and letting orjson parse bytes directly), but text frames from older
+    clients still work.
+    """
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    return orjson.loads(message.get("bytes") or message["text"])
+
+
+async def ws_writer(websocket: WebSocket, out_q: asyncio.Queue, endpoint_task: asyncio.Task):
+    """Single writer task per connection: drain the outbound queue onto the socket.
+
+    Producers enqueue pre-serialized frames with put_nowait and never block on
+    socket write latency; only this task awaits the actual send. When a send
+    fails (client gone), the endpoint task is cancelled so in-flight agent
+    work — including long billable tool calls — aborts instead of running the
+    turn to completion into a dead queue.
+    """
+    try:
+        while True:
+            frame = await out_q.get()
+            await websocket.send_bytes(frame)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        endpoint_task.cancel()
+
+
+def try_enqueue(out_q: asyncio.Queue, frame: bytes):
+    """Best-effort enqueue for error/cleanup paths.
+
+    A full queue here means the writer is dead or hopelessly behind; drop the
+    frame rather than raise a second error out of an except/finally block.
+    """
+    try:
+        out_q.put_nowait(frame)
+    except asyncio.QueueFull:
+        pass
+
+
 @app.websocket("/ws/{session_id}")
 async def websocket_endpoint(websocket: WebSocket, session_id: str):
     await websocket.accept()
-    messages = []  # Conversation history
+    out_q = asyncio.Queue(maxsize=1024)
+    writer_task = asyncio.create_task(ws_writer(websocket, out_q, asyncio.current_task()))
+
+    # Conversation history. Every entry is a plain dict/list/str tree — never
+    # an SDK model — and is mutated in place (append/trim/cache markers), so
+    # each stream call serializes the entries directly without defensive
+    # copies or pydantic conversion.
+    messages = []
 
     try:
         while True:
-            data = await websocket.receive_json()
+            data = await receive_json(websocket)
 
             # Handle clear command
             if data.get("type") == "clear":
-                messages = []
-                await websocket.send_json({"type": "cleared"})
+                messages.clear()
+                out_q.put_nowait(FRAME_CLEARED)
                 continue
 
             # Build message content
             content = []
             uploaded_image_urls = []
 
-            # Process media attachments
-            for media in data.get("media", []):
-                if media["type"] == "image":
-                    content.append({
-                        "type": "image",
-                        "source": {
-                            "type": "base64",
-                            "media_type": media["media_type"],
-                            "data": media["data"]
-                        }
-                    })
-                    # Upload to Fal CDN for tool access
-                    fal_url = await upload_base64_to_fal(media["data"], media["media_type"])
+            # Process media attachments. Decode each base64 payload once and
+            # upload all images to Fal concurrently.
+            images = [m for m in data.get("media", []) if m["type"] == "image"]
+            if images:
+                decoded = [binascii.a2b_base64(m["data"]) for m in images]
+                fal_urls = await asyncio.gather(*[
+                    upload_bytes_to_fal(image_bytes, m["media_type"])
+                    for image_bytes, m in zip(decoded, images)
+                ])
+                for media, fal_url in zip(images, fal_urls):
                     if fal_url:
+                        # URL source keeps the multi-MB base64 payload out of
+                        # the prompt (and out of every cached prefix).
+                        content.append({
+                            "type": "image",
+                            "source": {"type": "url", "url": fal_url}
+                        })
                         uploaded_image_urls.append(fal_url)
+                    else:
+                        content.append({
+                            "type": "image",
+                            "source": {
+                                "type": "base64",
+                                "media_type": media["media_type"],
+                                "data": media["data"]
+                            }
+                        })
 
             # Add text content
             text = data.get("text", "").strip()
             if text:
                 content.append({"type": "text", "text": text})
 
-            # Append image URLs for tools
+            # Append image URLs for tools as a dedicated block in a fixed
+            # position (after the text), one URL per line.
             if uploaded_image_urls:
                 content.append({
                     "type": "text",
-                    "text": f"[System: User uploaded images. URLs for tools: {', '.join(uploaded_image_urls)}]"
+                    "text": UPLOAD_MARKER_PREFIX + "\n".join(uploaded_image_urls) + "]"
                 })
 
             if not content:
                 continue
 
             messages.append({"role": "user", "content": content})
-            await websocket.send_json({"type": "thinking", "status": True})
+            trim_history(messages)
+            out_q.put_nowait(FRAME_THINKING_ON)
 
             try:
-                await run_agent_loop(websocket, messages)
+                await run_agent_loop(out_q, messages)
             except Exception as e:
-                traceback.print_exc()
-                await websocket.send_json({"type": "error", "message": str(e)})
+                logger.exception("Agent loop error")
+                try_enqueue(out_q, orjson.dumps({"type": "error", "message": str(e)}))
             finally:
-                await websocket.send_json({"type": "thinking", "status": False})
+                try_enqueue(out_q, FRAME_THINKING_OFF)
 
     except WebSocketDisconnect:
         logger.info(f"Client {session_id} disconnected")
+    except asyncio.CancelledError:
+        # Cancelled by ws_writer after a failed send; anything else (server
+        # shutdown) must keep propagating.
+        if not writer_task.done():
+            raise
+        logger.info(f"Client {session_id} disconnected")
+    finally:
+        writer_task.cancel()
 
 
-async def run_agent_loop(websocket: WebSocket, messages: list):
+def fast_turn_eligible(messages: list) -> bool:
+    """Short, text-only user turns can start on the fast model."""
+    content = messages[-1]["content"]
+    return (
+        all(block["type"] == "text" for block in content)
+        and sum(len(block["text"]) for block in content) < FAST_TURN_MAX_CHARS
+    )
+
+
+async def run_agent_loop(out_q: asyncio.Queue, messages: list):
     """Run the agent loop: stream response, execute tools, repeat until done."""
     tool_call_count = 0
 
+    # Model tiering: trivial turns go to the fast model first; if it reaches
+    # for a tool, the turn is re-run on the stronger model below.
+    model = MODEL
+    if ENABLE_MODEL_TIERING and FAST_MODEL and fast_turn_eligible(messages):
+        model = FAST_MODEL
+
     while True:
+        mark_cache_breakpoint(messages)
+
+        # A fast-model attempt is a probe: nothing is sent to the client
+        # until it finishes without tools, so a discarded attempt leaves no
+        # stale text or spinning tool chips behind in the UI.
+        probing = model != MODEL
+        escalate = False
+
         # Stream Claude's response
-        with client.messages.stream(
-            model=MODEL,
+        async with client.messages.stream(
+            model=model,
             max_tokens=4096,
-            system=SYSTEM_PROMPT,
+            system=SYSTEM_BLOCKS,
             messages=messages,
-            tools=TOOLS_SCHEMA or None,
+            tools=TOOLS_ARG,
         ) as stream:
-            # Stream text deltas and tool starts to frontend
-            for event in stream:
+            # Stream text deltas and tool starts to frontend. Deltas are
+            # buffered and flushed in batches so a 100-token/s stream doesn't
+            # turn into 100 WS frames (and kernel sends) per second.
+            delta_buffer = []
+            delta_size = 0
+            last_flush = time.monotonic()
+
+            async def flush_deltas():
+                nonlocal delta_size, last_flush
+                if delta_buffer:
+                    out_q.put_nowait(orjson.dumps({
+                        "type": "text_delta",
+                        "text": "".join(delta_buffer)
+                    }))
+                    delta_buffer.clear()
+                    delta_size = 0
+                last_flush = time.monotonic()
+
+            # Accumulate the history blocks directly from stream events so we
+            # never need to materialize (and re-walk) the final message.
+            assistant_content = []
+            tool_json_parts = None  # partial JSON of the open tool_use block
+
+            async for event in stream:
                 if event.type == "content_block_start":
-                    if event.content_block.type == "tool_use":
-                        await websocket.send_json({
-                            "type": "tool_start",
-                            "tool_id": event.content_block.id,
-                            "name": event.content_block.name
+                    block = event.content_block
+                    if block.type == "text":
+                        assistant_content.append({"type": "text", "text": ""})
+                    elif block.type == "tool_use":
+                        if probing:
+                            # The fast model reached for a tool: stop reading
+                            # and re-run on the full model, which plans tools
+                            # better. The client has seen none of this yet.
+                            escalate = True
+                            break
+                        await flush_deltas()
+                        assistant_content.append({
+                            "type": "tool_use",
+                            "id": block.id,
+                            "name": block.name,
+                            "input": {}
                         })
+                        tool_json_parts = []
+                        out_q.put_nowait(orjson.dumps({
+                            "type": "tool_start",
+                            "tool_id": block.id,
+                            "name": block.name
+                        }))
                 elif event.type == "content_block_delta":
                     if event.delta.type == "text_delta":
-                        await websocket.send_json({
-                            "type": "text_delta",
-                            "text": event.delta.text
-                        })
-
-            # Get complete message
-            final_message = stream.get_final_message()
-
-        # Build assistant content for history
-        assistant_content = []
-        for block in final_message.content:
-            if block.type == "text":
-                assistant_content.append({"type": "text", "text": block.text})
-            elif block.type == "tool_use":
-                assistant_content.append({
-                    "type": "tool_use",
-                    "id": block.id,
-                    "name": block.name,
-                    "input": block.input
-                })
+                        assistant_content[-1]["text"] += event.delta.text
+                        delta_buffer.append(event.delta.text)
+                        delta_size += len(event.delta.text)
+                        if not probing and (
+                                delta_size >= DELTA_FLUSH_CHARS
+                                or time.monotonic() - last_flush >= DELTA_FLUSH_INTERVAL):
+                            await flush_deltas()
+                    elif event.delta.type == "input_json_delta":
+                        tool_json_parts.append(event.delta.partial_json)
+                elif event.type == "content_block_stop":
+                    if tool_json_parts is not None:
+                        tool_json = "".join(tool_json_parts)
+                        if tool_json:
+                            assistant_content[-1]["input"] = orjson.loads(tool_json)
+                        tool_json_parts = None
+
+            if not escalate:
+                # For a completed probe this is the first and only flush,
+                # pushing the whole buffered response in one frame.
+                await flush_deltas()
+
+        if escalate:
+            model = MODEL
+            continue
 
         messages.append({"role": "assistant", "content": assistant_content})
 
         # Check for tool calls
-        tool_uses = [b for b in final_message.content if b.type == "tool_use"]
+        tool_uses = [b for b in assistant_content if b["type"] == "tool_use"]
 
         if not tool_uses:
             break  # No tools, we're done
@@ -182,23 +460,39 @@ async def run_agent_loop(websocket: WebSocket, messages: list):
             logger.warning(f"Tool call limit ({MAX_TOOL_CALLS}) reached")
             break
 
-        # Execute tools
+        # Execute tools in parallel: calls in one turn are independent (e.g.
+        # start/end video frames), so wall time is max(t) instead of sum(t).
+        results = await execute_tools([(tu["name"], tu["input"]) for tu in tool_uses])
+
         tool_results = []
-        for tool_use in tool_uses:
-            result = await execute_tool(tool_use.name, tool_use.input)
+        for tool_use, result in zip(tool_uses, results):
+            if isinstance(result, BaseException):
+                logger.error(f"Tool {tool_use['name']} failed: {result}")
+                result = f"Error: {result}"
             tool_results.append({
                 "type": "tool_result",
-                "tool_use_id": tool_use.id,
+                "tool_use_id": tool_use["id"],
                 "content": result
             })
-            await websocket.send_json({"type": "tool_end", "tool_id": tool_use.id})
+            out_q.put_nowait(orjson.dumps({
+                "type": "tool_end",
+                "tool_id": tool_use["id"],
+                "size": len(result)
+            }))
+            # Full result in its own frame so the frontend never needs a
+            # second round-trip for tool output.
+            out_q.put_nowait(orjson.dumps({
+                "type": "tool_result",
+                "tool_id": tool_use["id"],
+                "data": result
+            }))
 
         messages.append({"role": "user", "content": tool_results})
 
         # Signal new turn for frontend
-        await websocket.send_json({"type": "new_turn"})
+        out_q.put_nowait(FRAME_NEW_TURN)
 
-    await websocket.send_json({"type": "done"})
+    out_q.put_nowait(FRAME_DONE)
 
 
 @app.get("/health")
@@ -208,4 +502,13 @@ async def health():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        ws="websockets",
+        # Explicit bound for inbound frames (base64 uploads can be several MB)
+        ws_max_size=32 * 1024 * 1024,
+    )
@@ -1,184 +1,244 @@
 """
 Custom tools for the PopAd.ai marketing agent.
+
+Baseline tools (time, calculator) and the dispatcher live in tools_core;
+this module adds the Fal-backed image and video generation tools.
 """
-import ast
+import asyncio
 import logging
-import operator
 import os
-from datetime import datetime
+import random
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from hashlib import blake2b
+from types import MappingProxyType
 
 import httpx
+import orjson
 
-logger = logging.getLogger(__name__)
-
-# Aspect ratio mappings for Fal AI
-IMAGE_ASPECT_RATIOS = {"square": "1:1", "landscape": "16:9", "portrait": "9:16"}
-VIDEO_ASPECT_RATIOS = {"auto": "auto", "landscape": "16:9", "portrait": "9:16"}
-
-# Tool schemas for Claude API
-TOOLS_SCHEMA = [
-    {
-        "name": "get_current_time",
-        "description": "Get the current date and time",
-        "input_schema": {
-            "type": "object",
-            "properties": {},
-            "required": []
-        }
-    },
-    {
-        "name": "calculator",
-        "description": "Perform basic math calculations. Supports +, -, *, /, and ** (power)",
-        "input_schema": {
-            "type": "object",
-            "properties": {
-                "expression": {
-                    "type": "string",
-                    "description": "The math expression to evaluate, e.g. '2 + 2' or '10 * 5'"
-                }
-            },
-            "required": ["expression"]
-        }
-    },
-    {
-        "name": "generate_image",
-        "description": "Generate or edit images using AI. Can create new images from text prompts, or edit/transform existing images. When editing, pass the image URLs provided by the system. Returns the URL of the generated image.",
-        "input_schema": {
-            "type": "object",
-            "properties": {
-                "prompt": {
-                    "type": "string",
-                    "description": "Text description of the image to generate, or instructions for how to edit/transform the input images"
-                },
-                "image_urls": {
-                    "type": "array",
-                    "items": {"type": "string"},
-                    "description": "Optional. URLs of 1-3 existing images to edit or use as reference. Use the URLs provided by the system when the user uploads images."
-                },
-                "aspect_ratio": {
-                    "type": "string",
-                    "enum": ["square", "landscape", "portrait"],
-                    "description": "Aspect ratio for the output image. Defaults to 'square'. Use 'landscape' for 16:9, 'portrait' for 9:16."
-                }
-            },
-            "required": ["prompt"]
-        }
-    },
-    {
-        "name": "generate_video",
-        "description": "Generate a video from start and end frame images using AI (Veo 3.1). Takes two image URLs (first frame and last frame) and creates a smooth video transition between them. Use this after generating start/end frame images with generate_image. Returns the URL of the generated video.",
-        "input_schema": {
-            "type": "object",
-            "properties": {
-                "prompt": {
-                    "type": "string",
-                    "description": "Text describing the video motion/transition between the start and end frames"
-                },
-                "first_frame_url": {
-                    "type": "string",
-                    "description": "URL of the video's opening frame image"
-                },
-                "last_frame_url": {
-                    "type": "string",
-                    "description": "URL of the video's closing frame image"
-                },
-                "aspect_ratio": {
-                    "type": "string",
-                    "enum": ["auto", "landscape", "portrait"],
-                    "description": "Video aspect ratio. 'landscape' = 16:9, 'portrait' = 9:16. Defaults to 'auto'."
-                },
-                "duration": {
-                    "type": "string",
-                    "enum": ["4s", "6s", "8s"],
-                    "description": "Video duration. Defaults to '8s'."
-                }
-            },
-            "required": ["prompt", "first_frame_url", "last_frame_url"]
-        }
-    },
-]
-
+from tools_core import (
+    TOOLS_SCHEMA,
+    TOOL_HANDLERS,
+    execute_tool,
+    execute_tools,
+    register_tool,
+)
 
-# Tool implementations
+logger = logging.getLogger(__name__)
 
-async def get_current_time_impl(_args: dict) -> str:
-    """Returns the current date and time."""
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+# Aspect ratio mappings for Fal AI (read-only: these are lookup constants)
+IMAGE_ASPECT_RATIOS = MappingProxyType({"square": "1:1", "landscape": "16:9", "portrait": "9:16"})
+VIDEO_ASPECT_RATIOS = MappingProxyType({"auto": "auto", "landscape": "16:9", "portrait": "9:16"})
+
+# Shared HTTP client for all tool calls: connection pooling + TLS session
+# reuse to fal.run instead of a handshake per call. Lazily built and keyed to
+# the running event loop so a client from a dead loop is never reused.
+_client: httpx.AsyncClient | None = None
+_client_loop_id: int | None = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _client, _client_loop_id
+    loop_id = id(asyncio.get_running_loop())
+    if _client is None or _client_loop_id != loop_id:
+        _client = httpx.AsyncClient(
+            http2=True,
+            # Fal JSON bodies (long CDN URLs, metadata) compress well; brotli
+            # beats gzip on them and HPACK makes the repeated headers ~free.
+            headers={"Accept-Encoding": "br, gzip"},
+            timeout=httpx.Timeout(300.0, connect=10.0),
+            limits=httpx.Limits(
+                max_keepalive_connections=20,
+                max_connections=100,
+                keepalive_expiry=30,
+            ),
+        )
+        _client_loop_id = loop_id
+    return _client
+
+
+async def aclose_clients():
+    """Close the shared HTTP client (called from the app's lifespan shutdown)."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+# Per-endpoint budgets: only the read stage should get the long generation
+# window. A tight connect/write/pool budget means a stuck connection fails in
+# seconds and frees its pool slot, instead of holding it for the full 2-5 min.
+IMG_TIMEOUT = httpx.Timeout(connect=5.0, read=120.0, write=10.0, pool=5.0)
+VID_TIMEOUT = httpx.Timeout(connect=5.0, read=300.0, write=10.0, pool=5.0)
+
+_MAX_RETRIES = 3
+
+
+async def _post_with_retry(url: str, *, content: bytes, headers: dict, timeout: httpx.Timeout) -> httpx.Response:
+    """POST pre-encoded JSON bytes with retries on transient failures
+    (connect/read errors, 5xx).
+
+    Exponential backoff with jitter between attempts; 4xx responses and the
+    final attempt's outcome go straight back to the caller. Content-Type is
+    already in the headers.
+    """
+    client = _get_client()
+    for attempt in range(_MAX_RETRIES):
+        last_attempt = attempt == _MAX_RETRIES - 1
+        try:
+            response = await client.post(url, content=content, headers=headers, timeout=timeout)
+            if response.status_code < 500 or last_attempt:
+                return response
+        except (httpx.ConnectError, httpx.ReadError):
+            if last_attempt:
+                raise
+        await asyncio.sleep(0.25 * 2 ** attempt * (1 + random.random()))
+    return response
+
+
+# Static request fragments, built once instead of per call. For images only
+# prompt and image_urls vary, so the invariant tail of the JSON body is
+# pre-encoded per aspect ratio and the request is assembled by concatenation.
+_IMG_TAILS = {
+    ratio: b',"num_images":1,"aspect_ratio":' + orjson.dumps(ratio) + b',"output_format":"png"}'
+    for ratio in IMAGE_ASPECT_RATIOS.values()
+}
+_VIDEO_TEMPLATE = {
+    "prompt": "",
+    "first_frame_url": "",
+    "last_frame_url": "",
+    "aspect_ratio": "auto",
+    "duration": "8s",
+    "generate_audio": True,
+}
 
 
-async def calculator_impl(args: dict) -> str:
-    """Safely evaluate a math expression."""
-    ops = {
-        ast.Add: operator.add,
-        ast.Sub: operator.sub,
-        ast.Mult: operator.mul,
-        ast.Div: operator.truediv,
-        ast.Pow: operator.pow,
-    }
+# Typed views over the raw tool-call args: one decode point per tool instead
+# of args.get chains scattered through the impl bodies.
+
+@dataclass(slots=True)
+class ImageArgs:
+    prompt: str = ""
+    image_urls: list = field(default_factory=list)
+    aspect_ratio: str = "square"
+    no_cache: bool = False
+
+    @classmethod
+    def from_dict(cls, args: dict) -> "ImageArgs":
+        return cls(
+            prompt=args.get("prompt", ""),
+            image_urls=args.get("image_urls") or [],
+            aspect_ratio=args.get("aspect_ratio") or "square",
+            no_cache=bool(args.get("no_cache")),
+        )
+
+
+@dataclass(slots=True)
+class VideoArgs:
+    prompt: str = ""
+    first_frame_url: str = ""
+    last_frame_url: str = ""
+    aspect_ratio: str = "auto"
+    duration: str = "8s"
+
+    @classmethod
+    def from_dict(cls, args: dict) -> "VideoArgs":
+        return cls(
+            prompt=args.get("prompt", ""),
+            first_frame_url=args.get("first_frame_url", ""),
+            last_frame_url=args.get("last_frame_url", ""),
+            aspect_ratio=args.get("aspect_ratio") or "auto",
+            duration=args.get("duration") or "8s",
+        )
+
+
+# FAL_KEY is read once at import (main.py loads .env first); the request
+# path just checks a module constant. fal_configured() lets the app surface
+# a missing key at startup instead of on the first tool call.
+_FAL_KEY = os.environ.get("FAL_KEY")
+_AUTH_HEADERS: dict | None = (
+    {"Authorization": f"Key {_FAL_KEY}", "Content-Type": "application/json"}
+    if _FAL_KEY
+    else None
+)
+
+
+def fal_configured() -> bool:
+    """Whether the Fal tools have a FAL_KEY to authenticate with."""
+    return _AUTH_HEADERS is not None
+
+
+# Result cache: agents regularly re-issue identical generation requests
+# (retries, plan re-entry), and each one is a ~60s Fal call. Keyed on the
+# normalized args, bounded LRU.
+_GEN_CACHE_MAX = 256
+_gen_cache: OrderedDict[str, str] = OrderedDict()
+
+
+async def _head_ok(url: str) -> bool:
+    """Cheap reachability probe: HEAD with a 2s budget, False on any failure."""
+    try:
+        response = await _get_client().head(url, timeout=2.0)
+        return response.status_code < 400
+    except Exception:
+        return False
 
-    def eval_node(node):
-        if isinstance(node, ast.Constant):
-            return node.value
-        if isinstance(node, ast.Num):  # Python 3.7 compat
-            return node.n
-        if isinstance(node, ast.BinOp):
-            return ops[type(node.op)](eval_node(node.left), eval_node(node.right))
-        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
-            return -eval_node(node.operand)
-        raise ValueError("Unsupported expression")
 
-    try:
-        tree = ast.parse(args["expression"], mode="eval")
-        return str(eval_node(tree.body))
-    except Exception as e:
-        return f"Error: {e}"
+def _gen_cache_key(a: ImageArgs) -> str:
+    return blake2b(
+        orjson.dumps({"p": a.prompt, "u": sorted(a.image_urls[:3]), "a": a.aspect_ratio}),
+        digest_size=16,
+    ).hexdigest()
 
 
 async def generate_image_impl(args: dict) -> str:
     """Generate or edit an image using Fal AI's nano-banana-pro model."""
-    fal_key = os.environ.get("FAL_KEY")
-    if not fal_key:
+    headers = _AUTH_HEADERS
+    if headers is None:
         return "Error: FAL_KEY not configured"
 
-    prompt = args.get("prompt", "")
-    image_urls = args.get("image_urls", [])
-    aspect_ratio = IMAGE_ASPECT_RATIOS.get(args.get("aspect_ratio", "square"), "1:1")
+    a = ImageArgs.from_dict(args)
+
+    cache_key = _gen_cache_key(a)
+    if not a.no_cache:
+        cached = _gen_cache.get(cache_key)
+        if cached is not None:
+            _gen_cache.move_to_end(cache_key)
+            return cached
+
+    body = b'{"prompt":' + orjson.dumps(a.prompt)
 
     # Choose endpoint based on whether we're editing or generating
-    if image_urls:
+    if a.image_urls:
+        source_urls = a.image_urls[:3]
+        # Fail fast on dead source URLs: a parallel 2s HEAD each beats
+        # letting Fal burn its full timeout on an unreachable input.
+        reachable = await asyncio.gather(*(_head_ok(u) for u in source_urls))
+        bad = [u for u, ok in zip(source_urls, reachable) if not ok]
+        if bad:
+            return f"Error: unreachable image_urls: {', '.join(bad)}"
         url = "https://fal.run/fal-ai/nano-banana-pro/edit"
-        payload = {
-            "prompt": prompt,
-            "image_urls": image_urls[:3],
-            "num_images": 1,
-            "aspect_ratio": aspect_ratio,
-            "output_format": "png",
-        }
+        body += b',"image_urls":' + orjson.dumps(source_urls)
     else:
         url = "https://fal.run/fal-ai/nano-banana-pro"
-        payload = {
-            "prompt": prompt,
-            "num_images": 1,
-            "aspect_ratio": aspect_ratio,
-            "output_format": "png",
-        }
 
-    headers = {
-        "Authorization": f"Key {fal_key}",
-        "Content-Type": "application/json",
-    }
+    body += _IMG_TAILS[IMAGE_ASPECT_RATIOS.get(a.aspect_ratio, "1:1")]
 
     try:
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(url, json=payload, headers=headers)
-            response.raise_for_status()
-            data = response.json()
+        response = await _post_with_retry(url, content=body, headers=headers, timeout=IMG_TIMEOUT)
+        response.raise_for_status()
+        data = orjson.loads(response.content)
 
         images = data.get("images", [])
         if not images or not images[0].get("url"):
             return "Error: No image URL in response"
 
-        return images[0]["url"]
+        image_url = images[0]["url"]
+        _gen_cache[cache_key] = image_url
+        _gen_cache.move_to_end(cache_key)
+        if len(_gen_cache) > _GEN_CACHE_MAX:
+            _gen_cache.popitem(last=False)
+        return image_url
 
     except httpx.TimeoutException:
         return "Error: Image generation timed out (120s)"
@@ -193,39 +253,31 @@ async def generate_image_impl(args: dict) -> str:
 
 async def generate_video_impl(args: dict) -> str:
     """Generate a video from start and end frame images using Fal AI's Veo 3.1."""
-    fal_key = os.environ.get("FAL_KEY")
-    if not fal_key:
+    headers = _AUTH_HEADERS
+    if headers is None:
         return "Error: FAL_KEY not configured"
 
-    first_frame = args.get("first_frame_url", "")
-    last_frame = args.get("last_frame_url", "")
+    a = VideoArgs.from_dict(args)
 
-    if not first_frame or not last_frame:
+    if not a.first_frame_url or not a.last_frame_url:
         return "Error: Both first_frame_url and last_frame_url are required"
 
-    payload = {
-        "prompt": args.get("prompt", ""),
-        "first_frame_url": first_frame,
-        "last_frame_url": last_frame,
-        "aspect_ratio": VIDEO_ASPECT_RATIOS.get(args.get("aspect_ratio", "auto"), "auto"),
-        "duration": args.get("duration", "8s"),
-        "generate_audio": True,
-    }
-
-    headers = {
-        "Authorization": f"Key {fal_key}",
-        "Content-Type": "application/json",
-    }
+    payload = _VIDEO_TEMPLATE.copy()
+    payload["prompt"] = a.prompt
+    payload["first_frame_url"] = a.first_frame_url
+    payload["last_frame_url"] = a.last_frame_url
+    payload["aspect_ratio"] = VIDEO_ASPECT_RATIOS.get(a.aspect_ratio, "auto")
+    payload["duration"] = a.duration
 
     try:
-        async with httpx.AsyncClient(timeout=300.0) as client:
-            response = await client.post(
-                "https://fal.run/fal-ai/veo3.1/fast/first-last-frame-to-video",
-                json=payload,
-                headers=headers
-            )
-            response.raise_for_status()
-            data = response.json()
+        response = await _post_with_retry(
+            "https://fal.run/fal-ai/veo3.1/fast/first-last-frame-to-video",
+            content=orjson.dumps(payload),
+            headers=headers,
+            timeout=VID_TIMEOUT,
+        )
+        response.raise_for_status()
+        data = orjson.loads(response.content)
 
         video_url = data.get("video", {}).get("url")
         if not video_url:
@@ -244,26 +296,86 @@ async def generate_video_impl(args: dict) -> str:
         return f"Error: {e}"
 
 
+# Error bodies can be arbitrarily large (HTML gateway pages, stack dumps);
+# never parse or decode more than this much of one.
+_ERR_BODY_CAP = 2048
+
+
 def _extract_error_detail(error: httpx.HTTPStatusError) -> str:
     """Extract error detail from Fal API response."""
+    # Read the raw body once and cap it up front; a body cut mid-JSON by the
+    # cap just falls through to the plain-text slice.
+    body = error.response.content[:_ERR_BODY_CAP]
     try:
-        return error.response.json().get("detail", error.response.text[:200])
+        return orjson.loads(body).get("detail", body[:200].decode("utf-8", "replace"))
     except Exception:
-        return error.response.text[:200]
+        return body[:200].decode("utf-8", "replace")
 
 
-# Tool dispatcher
-TOOL_HANDLERS = {
-    "get_current_time": get_current_time_impl,
-    "calculator": calculator_impl,
-    "generate_image": generate_image_impl,
-    "generate_video": generate_video_impl,
-}
-
+register_tool(
+    {
+        "name": "generate_image",
+        "description": "Generate or edit images using AI. Can create new images from text prompts, or edit/transform existing images. When editing, pass the image URLs provided by the system. Returns the URL of the generated image.",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "prompt": {
+                    "type": "string",
+                    "description": "Text description of the image to generate, or instructions for how to edit/transform the input images"
+                },
+                "image_urls": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "Optional. URLs of 1-3 existing images to edit or use as reference. Use the URLs provided by the system when the user uploads images."
+                },
+                "aspect_ratio": {
+                    "type": "string",
+                    "enum": ["square", "landscape", "portrait"],
+                    "description": "Aspect ratio for the output image. Defaults to 'square'. Use 'landscape' for 16:9, 'portrait' for 9:16."
+                },
+                "no_cache": {
+                    "type": "boolean",
+                    "description": "Optional. Set true to force a fresh generation when repeating an identical request; identical requests normally return the cached result."
+                }
+            },
+            "required": ["prompt"]
+        }
+    },
+    generate_image_impl,
+)
 
-async def execute_tool(name: str, args: dict) -> str:
-    """Execute a tool by name and return the result."""
-    handler = TOOL_HANDLERS.get(name)
-    if handler:
-        return await handler(args)
-    return f"Unknown tool: {name}"
+register_tool(
+    {
+        "name": "generate_video",
+        "description": "Generate a video from start and end frame images using AI (Veo 3.1). Takes two image URLs (first frame and last frame) and creates a smooth video transition between them. Use this after generating start/end frame images with generate_image. Returns the URL of the generated video.",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "prompt": {
+                    "type": "string",
+                    "description": "Text describing the video motion/transition between the start and end frames"
+                },
+                "first_frame_url": {
+                    "type": "string",
+                    "description": "URL of the video's opening frame image"
+                },
+                "last_frame_url": {
+                    "type": "string",
+                    "description": "URL of the video's closing frame image"
+                },
+                "aspect_ratio": {
+                    "type": "string",
+                    "enum": ["auto", "landscape", "portrait"],
+                    "description": "Video aspect ratio. 'landscape' = 16:9, 'portrait' = 9:16. Defaults to 'auto'."
+                },
+                "duration": {
+                    "type": "string",
+                    "enum": ["4s", "6s", "8s"],
+                    "description": "Video duration. Defaults to '8s'."
+                }
+            },
+            "required": ["prompt", "first_frame_url", "last_frame_url"]
+        }
+    },
+    generate_video_impl,
+)
@@ -0,0 +1,278 @@
+"""
+Shared tool machinery: baseline tools, schema, and dispatcher.
+
+Variant tool modules (tools.py, tools_sample.py) import from here and add
+their own tools via register_tool(), so the baseline schemas and impls are
+defined and compiled exactly once.
+"""
+import asyncio
+import logging
+import operator
+import re
+from datetime import datetime
+from functools import lru_cache
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+# Tool schemas for Claude API (baseline; variants append their own)
+TOOLS_SCHEMA = [
+    {
+        "name": "get_current_time",
+        "description": "Get the current date and time",
+        "input_schema": {
+            "type": "object",
+            "properties": {},
+            "required": []
+        }
+    },
+    {
+        "name": "calculator",
+        "description": "Perform basic math calculations. Supports +, -, *, /, and ** (power)",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "expression": {
+                    "type": "string",
+                    "description": "The math expression to evaluate, e.g. '2 + 2' or '10 * 5'"
+                }
+            },
+            "required": ["expression"]
+        }
+    },
+]
+
+
+# Tool implementations
+
+async def get_current_time_impl(_args: dict) -> str:
+    """Returns the current date and time."""
+    # Same output as strftime("%Y-%m-%d %H:%M:%S") without the locale-aware
+    # format-string machinery.
+    return datetime.now().isoformat(sep=" ", timespec="seconds")
+
+
+# Binary operator table: precedence and implementation. '**' is
+# right-associative; unary minus sits between '*' and '**' so that
+# -2**2 == -(2**2), matching Python.
+_BIN_OPS = {
+    "+": (1, operator.add),
+    "-": (1, operator.sub),
+    "*": (2, operator.mul),
+    "/": (2, operator.truediv),
+    "**": (4, operator.pow),
+}
+_UNARY_MINUS = "u-"
+_UNARY_PREC = 3
+_ALLOWED_CHARS = frozenset("0123456789.+-*/() \t")
+
+
+@lru_cache(maxsize=1024)
+def _parse_expr(expr: str) -> tuple:
+    """Tokenize a math expression and convert it to RPN (shunting-yard).
+
+    Supports numeric literals, + - * / ** and unary minus with Python
+    semantics; anything else raises ValueError. Far lighter than dragging
+    the full CPython parser through ast.parse for `2 + 2`, and the RPN
+    tuple is memoized per expression string.
+    """
+    if not expr or set(expr) - _ALLOWED_CHARS:
+        raise ValueError("Unsupported expression")
+
+    output = []
+    stack = []
+    i = 0
+    n = len(expr)
+    prev = None  # previous token kind: "num", "op", "(", ")"
+
+    while i < n:
+        ch = expr[i]
+        if ch in " \t":
+            i += 1
+            continue
+
+        if ch.isdigit() or ch == ".":
+            j = i + 1
+            while j < n and (expr[j].isdigit() or expr[j] == "."):
+                j += 1
+            text = expr[i:j]
+            output.append(float(text) if "." in text else int(text))
+            i = j
+            prev = "num"
+            continue
+
+        if ch == "(":
+            if prev in ("num", ")"):
+                raise ValueError("Unsupported expression")
+            stack.append("(")
+            i += 1
+            prev = "("
+            continue
+
+        if ch == ")":
+            while stack and stack[-1] != "(":
+                output.append(stack.pop())
+            if not stack:
+                raise ValueError("Unsupported expression")
+            stack.pop()
+            i += 1
+            prev = ")"
+            continue
+
+        if ch == "*" and i + 1 < n and expr[i + 1] == "*":
+            op = "**"
+            i += 2
+        else:
+            op = ch
+            i += 1
+
+        if op == "-" and prev not in ("num", ")"):
+            # Prefix operator: push without popping so its operand (possibly
+            # a ** expression) binds first.
+            stack.append(_UNARY_MINUS)
+            prev = "op"
+            continue
+
+        if op not in _BIN_OPS or prev not in ("num", ")"):
+            raise ValueError("Unsupported expression")
+
+        prec = _BIN_OPS[op][0]
+        right_assoc = op == "**"
+        while stack and stack[-1] != "(":
+            top = stack[-1]
+            top_prec = _UNARY_PREC if top == _UNARY_MINUS else _BIN_OPS[top][0]
+            if top_prec > prec or (top_prec == prec and not right_assoc):
+                output.append(stack.pop())
+            else:
+                break
+        stack.append(op)
+        prev = "op"
+
+    while stack:
+        top = stack.pop()
+        if top == "(":
+            raise ValueError("Unsupported expression")
+        output.append(top)
+
+    if not output:
+        raise ValueError("Unsupported expression")
+    return tuple(output)
+
+
+def _eval_rpn(rpn: tuple):
+    """Evaluate an RPN token tuple with an explicit stack."""
+    stack = []
+    push = stack.append
+    pop = stack.pop
+    for token in rpn:
+        if not isinstance(token, str):
+            push(token)
+        elif token == _UNARY_MINUS:
+            push(-pop())
+        else:
+            right = pop()
+            push(_BIN_OPS[token][1](pop(), right))
+    if len(stack) != 1:
+        raise ValueError("Unsupported expression")
+    return stack[0]
+
+
+# Fast path for the overwhelmingly common shapes ('42', '2 + 2'): one regex
+# match and a direct operator call, no shunting-yard and no RPN tuple. '**'
+# never matches (the second '*' breaks the operand) and falls through to the
+# full parser, as does anything parenthesized or chained.
+_SIMPLE_EXPR = re.compile(
+    r"[ \t]*(-?\d+(?:\.\d+)?)[ \t]*(?:([+\-*/])[ \t]*(-?\d+(?:\.\d+)?)[ \t]*)?"
+)
+_FAST_OPS = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "/": operator.truediv,
+}
+
+
+async def calculator_impl(args: dict) -> str:
+    """Safely evaluate a math expression."""
+    try:
+        expr = args["expression"]
+        m = _SIMPLE_EXPR.fullmatch(expr)
+        if m:
+            left, op, right = m.groups()
+            lhs = float(left) if "." in left else int(left)
+            if op is None:
+                return str(lhs)
+            rhs = float(right) if "." in right else int(right)
+            return str(_FAST_OPS[op](lhs, rhs))
+        return str(_eval_rpn(_parse_expr(expr)))
+    except Exception as e:
+        return f"Error: {e}"
+
+
+# Tool dispatcher. TOOL_HANDLERS stays the introspectable registry; the
+# actual per-call lookup goes through _Dispatcher, where each handler is a
+# staticmethod class attribute — a C-level attribute fetch on a __slots__
+# instance instead of a dict hash per call.
+TOOL_HANDLERS = {
+    "get_current_time": get_current_time_impl,
+    "calculator": calculator_impl,
+}
+
+
+class _Dispatcher:
+    __slots__ = ()
+    get_current_time = staticmethod(get_current_time_impl)
+    calculator = staticmethod(calculator_impl)
+
+
+_DISPATCH = _Dispatcher()
+
+
+# TOOLS_SCHEMA serialized once; callers that build raw API request bodies can
+# splice in the pre-encoded blob instead of re-encoding the schema per call.
+# (The anthropic SDK takes the live objects, so it keeps using TOOLS_SCHEMA.)
+_tools_schema_json: bytes | None = None
+
+
+def tools_schema_bytes() -> bytes:
+    """Return TOOLS_SCHEMA as pre-encoded JSON bytes, cached between registrations."""
+    global _tools_schema_json
+    if _tools_schema_json is None:
+        _tools_schema_json = orjson.dumps(TOOLS_SCHEMA)
+    return _tools_schema_json
+
+
+def register_tool(schema: dict, handler) -> None:
+    """Add a variant-specific tool to the schema and dispatcher."""
+    global _tools_schema_json
+    TOOLS_SCHEMA.append(schema)
+    TOOL_HANDLERS[schema["name"]] = handler
+    setattr(_Dispatcher, schema["name"], staticmethod(handler))
+    _tools_schema_json = None
+
+
+async def execute_tool(name: str, args: dict) -> str:
+    """Execute a tool by name and return the result."""
+    # The underscore guard keeps getattr from ever resolving dunders.
+    handler = getattr(_DISPATCH, name, None) if not name.startswith("_") else None
+    if handler is None:
+        # TOOL_HANDLERS is the authoritative registry: tools added to it
+        # directly (the README workflow) rather than via register_tool()
+        # must still dispatch, just without the attribute fast path.
+        handler = TOOL_HANDLERS.get(name)
+    if handler:
+        return await handler(args)
+    return f"Unknown tool: {name}"
+
+
+async def execute_tools(calls: list) -> list:
+    """Execute a batch of independent (name, args) tool calls concurrently.
+
+    Results come back in call order; a failed tool yields its exception in
+    place of a result instead of cancelling its siblings.
+    """
+    return await asyncio.gather(
+        *(execute_tool(name, args) for name, args in calls),
+        return_exceptions=True,
+    )
@@ -3,6 +3,10 @@ import ReactMarkdown from 'react-markdown'
 
 const SESSION_ID = crypto.randomUUID()
 
+// Outbound frames go as binary; the backend parses bytes directly
+const encoder = new TextEncoder()
+const wsSend = (ws, payload) => ws.send(encoder.encode(JSON.stringify(payload)))
+
 // Icons
 const SendIcon = () => (
   <svg width="20" height="20" viewBox="0 0 24 24" fill="none" stroke="currentColor" strokeWidth="2">
@@ -50,6 +54,7 @@ function App() {
   // WebSocket connection
   useEffect(() => {
     const socket = new WebSocket(`ws://localhost:8000/ws/${SESSION_ID}`)
+    socket.binaryType = 'arraybuffer'
 
     socket.onopen = () => {
       console.log('Connected')
@@ -63,7 +68,11 @@ function App() {
 
     socket.onerror = () => setError('Failed to connect to server')
 
-    socket.onmessage = (e) => handleServerMessage(JSON.parse(e.data))
+    // Server sends binary frames (orjson); decode before parsing
+    const decoder = new TextDecoder()
+    socket.onmessage = (e) => handleServerMessage(
+      JSON.parse(typeof e.data === 'string' ? e.data : decoder.decode(e.data))
+    )
 
     setWs(socket)
     return () => socket.close()
@@ -130,6 +139,24 @@ function App() {
         })
         break
 
+      case 'tool_result':
+        setMessages(prev => {
+          const lastMsg = prev[prev.length - 1]
+          if (lastMsg?.role === 'assistant' && lastMsg.tools) {
+            return [
+              ...prev.slice(0, -1),
+              {
+                ...lastMsg,
+                tools: lastMsg.tools.map(t =>
+                  t.id === data.tool_id ? { ...t, result: data.data } : t
+                )
+              }
+            ]
+          }
+          return prev
+        })
+        break
+
       case 'new_turn':
         pendingNewTurn.current = true
         break
@@ -194,7 +221,7 @@ function App() {
       media: media.map(m => ({ type: m.type, preview: m.preview }))
     }])
 
-    ws.send(JSON.stringify({
+    wsSend(ws, {
       type: 'message',
       text: input,
       media: media.map(m => ({
@@ -202,7 +229,7 @@ function App() {
         media_type: m.media_type,
         data: m.data
       }))
-    }))
+    })
 
     setIsWaiting(true)
     setInput('')
@@ -216,7 +243,7 @@ function App() {
     }
   }
 
-  const clearChat = () => ws?.send(JSON.stringify({ type: 'clear' }))
+  const clearChat = () => ws && wsSend(ws, { type: 'clear' })
 
   // Custom markdown renderer for video links
   const markdownComponents = {
@@ -266,7 +293,7 @@ function App() {
               {msg.tools?.length > 0 && (
                 <div className="tools">
                   {msg.tools.map(tool => (
-                    <div key={tool.id} className={`tool-call ${tool.status}`}>
+                    <div key={tool.id} className={`tool-call ${tool.status}`} title={tool.result}>
                       <ToolIcon />
                       <span className="name">{tool.name}</span>
                       <span className="status">